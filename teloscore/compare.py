@@ -1,8 +1,13 @@
 import csv
 import logging
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
 from io import StringIO
 from pathlib import Path
-from typing import Iterable, TextIO
+from typing import Iterable, Iterator, TextIO
+
+import numpy as np
 
 from .scoring import BaseScoringSystem
 from .types import TeloType
@@ -16,117 +21,200 @@ logging.basicConfig(level=logging.INFO)
 
 logger = logging.getLogger("teloscore")
 
-
-def build_telo_from_row(scoring: BaseScoringSystem, row: dict) -> TeloType:
-    tvr = row["tvr_consensus"]
-    return {
-        "arm": row["#chr"],
-        "allele_id": row["allele_id"],
-        "tvr_consensus": tvr,
-        "tvr_consensus_encoded": scoring.encode_seq(tvr),
-    }
+SCORE_DECIMAL_PLACES = 4
 
 
 def _fmt_allele(telo: TeloType) -> str:
     return f"({telo['allele_id']}) {telo['arm']}"
 
 
-def _fmt_alignment(seq1: str, seq2: str, cigar: Iterable[tuple[int, int]]) -> str:
+def _fmt_alignment(seq1: str, seq2: str, cigar: np.ndarray) -> str:
     chars1 = []
     line_chars = []
     chars2 = []
 
     qs, dbs = (seq1, seq2) if len(seq1) <= len(seq2) else (seq2, seq1)
 
-    s1 = list(qs)
-    s2 = list(dbs)
+    # Cursors into qs and dbs respectively
+    i1: int = 0
+    i2: int = 0
 
-    for op, count in cigar:
+    # CIGAR is an (n, 2) array of (operation, count) rows; convert to Python ints for string operations.
+    for op, count in cigar.tolist():
         # CIGAR operations are detailed here: https://samtools.github.io/hts-specs/SAMv1.pdf section 1.4 list item 6
         if op in (0, 7, 8):
-            for _ in range(count):
-                chars1.append(s1.pop(0))
-                line_chars.append("|" if op != 8 else "X")
-                chars2.append(s2.pop(0))
+            chars1.append(qs[i1 : i1 + count])
+            line_chars.append(("|" if op != 8 else "X") * count)
+            chars2.append(dbs[i2 : i2 + count])
+            i1 += count
+            i2 += count
         elif op == 1:
-            for _ in range(count):
-                chars1.append(s1.pop(0))
-                line_chars.append(" ")
-                chars2.append("-")
+            chars1.append(qs[i1 : i1 + count])
+            line_chars.append(" " * count)
+            chars2.append("-" * count)
+            i1 += count
         elif op in (2, 3):
-            for _ in range(count):
-                chars1.append("-")
-                line_chars.append(" ")
-                chars2.append(s2.pop(0))
+            chars1.append("-" * count)
+            line_chars.append(" " * count)
+            chars2.append(dbs[i2 : i2 + count])
+            i2 += count
         elif op == 4:
-            for _ in range(count):
-                s1.pop(0)
+            i1 += count
 
     return f"{''.join(chars1)}\n{''.join(line_chars)}\n{''.join(chars2)}"
 
 
-def _read_sample_files(scoring: BaseScoringSystem, file1: Path, file2: Path) -> tuple[list[TeloType], list[TeloType]]:
-    f1_arms: list[TeloType]
-    f2_arms: list[TeloType]
+def _read_sample_file(scoring: BaseScoringSystem, file: Path) -> list[TeloType]:
+    arms: list[TeloType] = []
 
-    def filter_row(r: dict) -> bool:
-        """Returns true if a row should be included."""
-        return not (r.get("tvr_len") == "0")  # Flexible TSV format: if tvr_len col doesn't exist, don't crash.
+    with open(file, "r") as fh:
+        r = csv.reader(fh, delimiter="\t")
 
-    with open(file1, "r") as fh1, open(file2, "r") as fh2:
-        r1 = csv.DictReader(fh1, delimiter="\t")
-        r2 = csv.DictReader(fh2, delimiter="\t")
+        if (header := next(r, None)) is None:  # empty file
+            return arms
 
-        row: dict
-        f1_arms = [scoring.build_telo_from_row(row) for row in filter(filter_row, r1)]
-        f2_arms = [scoring.build_telo_from_row(row) for row in filter(filter_row, r2)]
+        # required columns: #chr/chr    allele_id    tvr_consensus
+        if "#chr" in header:
+            chr_i = header.index("#chr")
+        elif "chr" in header:
+            chr_i = header.index("chr")
+        else:
+            raise ValueError(f"Could not find chromosome arm column in header: {header}")
+        allele_id_i = header.index("allele_id")
+        tvr_i = header.index("tvr_consensus")
+        # Flexible TSV format: if tvr_len col doesn't exist, don't crash.
+        tvr_len_i = header.index("tvr_len") if "tvr_len" in header else None
 
-    return f1_arms, f2_arms
+        for row in r:
+            if not row:  # blank line
+                continue
 
+            if tvr_len_i is not None and row[tvr_len_i] == "0":
+                continue
 
-def _compute_matrix(scoring: BaseScoringSystem, f1_arms: list[TeloType], f2_arms: list[TeloType]) -> list[list[float]]:
-    matrix: list[list[float]] = [[0.0 for _j in f1_arms] for _i in f2_arms]
+            arms.append(scoring.build_telo_from_row(row, chr_i, allele_id_i, tvr_i))
 
-    for i, f1a in enumerate(f1_arms):
-        for j, f2a in enumerate(f2_arms):
-            score, cigar = scoring.score_seqs(f1a["tvr_consensus_encoded"], f2a["tvr_consensus_encoded"])
-            matrix[j][i] = score
-            if score > scoring.score_log_threshold:
-                logger.info(
-                    f"Found score >{scoring.score_log_threshold}: {_fmt_allele(f1a)} against {_fmt_allele(f2a)}; "
-                    f"score: {score:.3f}"
-                )
-                logger.info(
-                    f"  Alignment: \n"
-                    f"{_fmt_alignment(f1a['tvr_consensus_encoded'], f2a['tvr_consensus_encoded'], cigar)}"
-                )
+    return arms
 
-    return matrix
+
+def _read_sample_files(scoring: BaseScoringSystem, file1: Path, file2: Path) -> tuple[list[TeloType], list[TeloType]]:
+    return _read_sample_file(scoring, file1), _read_sample_file(scoring, file2)
+
+
+def _score_row(
+    scoring: BaseScoringSystem, f1_seqs: list[str], f2_seq: str, mirror_cols: frozenset[int] = frozenset()
+) -> list[float]:
+    # Scores for f1 sequences at indices in mirror_cols are left as NaN, to be filled in from the other half of a
+    # symmetric matrix.
+    return [math.nan if a in mirror_cols else scoring.score_only(f1_seq, f2_seq) for a, f1_seq in enumerate(f1_seqs)]
+
+
+def _seq_sort_key(seq: str) -> tuple[int, str]:
+    return len(seq), seq
+
+
+def _log_high_scores(scoring: BaseScoringSystem, f1_arms: list[TeloType], f2a: TeloType, scores: np.ndarray):
+    for i in np.flatnonzero(scores > scoring.score_log_threshold):
+        f1a = f1_arms[i]
+        # Only re-align with a traceback for the (few) scores which are high enough to be logged
+        _, cigar = scoring.score_seqs(f1a["tvr_consensus_encoded"], f2a["tvr_consensus_encoded"])
+        logger.info(
+            f"Found score >{scoring.score_log_threshold}: {_fmt_allele(f1a)} against {_fmt_allele(f2a)}; "
+            f"score: {scores[i]:.3f}"
+        )
+        logger.info(
+            f"  Alignment: \n{_fmt_alignment(f1a['tvr_consensus_encoded'], f2a['tvr_consensus_encoded'], cigar)}"
+        )
+
+
+def _iter_matrix_rows(
+    scoring: BaseScoringSystem, f1_arms: list[TeloType], f2_arms: list[TeloType]
+) -> Iterator[np.ndarray]:
+    """
+    Yields rows of the scoring matrix (one per f2 arm, with one column per f1 arm) in order, as soon as each is ready.
+    """
+    # Many alleles share the same encoded TVR sequence, so we only align each unique pair of sequences once and then
+    # scatter the results back out to all arm pairs.
+    # Within each row, the unique f1 sequences are sorted by length, so that similarly-sized sequences are aligned one
+    # after another. Rows (unique f2 sequences) are computed in order of first appearance, so output rows can be written
+    # while later rows are still computing.
+    f1_seqs = sorted({f1a["tvr_consensus_encoded"] for f1a in f1_arms}, key=_seq_sort_key)
+    f2_seqs = list(dict.fromkeys(f2a["tvr_consensus_encoded"] for f2a in f2_arms))
+
+    f1_idx: dict[str, int] = {seq: a for a, seq in enumerate(f1_seqs)}
+    f2_idx: dict[str, int] = {seq: b for b, seq in enumerate(f2_seqs)}
+
+    # Column indices into a unique-sequence row for each f1 arm
+    f1_arm_idx = np.array([f1_idx[f1a["tvr_consensus_encoded"]] for f1a in f1_arms], dtype=np.intp)
+
+    # When comparing a sample against itself, scores are symmetric, so (mostly) only half of the matrix is computed.
+    symmetric = scoring.symmetric_scores and f1_idx.keys() == f2_idx.keys()
+
+    def _mirror_cols(b: int) -> frozenset[int]:
+        # Columns which can be taken from an earlier row, i.e. one already computed by the time this row is used.
+        # Equal-length sequences are always scored, since the order of the sequences determines which one is the query
+        # (and thus how the score is normalized).
+        if not symmetric:
+            return frozenset()
+        f2_seq = f2_seqs[b]
+        return frozenset(a for a, f1_seq in enumerate(f1_seqs) if f2_idx[f1_seq] < b and len(f1_seq) != len(f2_seq))
+
+    unique_rows: list[np.ndarray] = []
+    j: int = 0  # next f2 arm (output row) to yield
+
+    # parasail releases the GIL while aligning, so we can compute rows (one per unique f2 sequence) in parallel using
+    # threads. Finished rows are handed back in order, so output can be written while later rows are still computing.
+    executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+    try:
+        results = executor.map(
+            lambda b: _score_row(scoring, f1_seqs, f2_seqs[b], mirror_cols=_mirror_cols(b)), range(len(f2_seqs))
+        )
+
+        for b, result in enumerate(results):
+            row = np.array(result, dtype=np.float64)
+            for a in np.flatnonzero(np.isnan(row)):
+                row[a] = unique_rows[f2_idx[f1_seqs[a]]][f1_idx[f2_seqs[b]]]
+            unique_rows.append(row)
+
+            # Yield any f2 arms whose sequences have now been scored, in order
+            while j < len(f2_arms) and (u := f2_idx[f2_arms[j]["tvr_consensus_encoded"]]) < len(unique_rows):
+                f2a = f2_arms[j]
+                scores = unique_rows[u][f1_arm_idx]
+                _log_high_scores(scoring, f1_arms, f2a, scores)
+                # Yield full-precision scores: rounding to float32 before formatting can change the last decimal place
+                # written out, e.g. for 3/160.
+                yield scores
+                j += 1
+    finally:
+        # If the consumer stops early (or raises), don't wait for all the remaining rows to be computed.
+        executor.shutdown(cancel_futures=True)
 
 
 def _write_outfile(
     f1_arms: list[TeloType],
     f2_arms: list[TeloType],
     out_file: Path | StringIO,
-    matrix: list[list[float]],
+    matrix: Iterable[np.ndarray],
 ):
+    # matrix can be either a full matrix or an iterator of rows, which are written out as they are produced.
+    row_fmt = f"\t%.{SCORE_DECIMAL_PLACES}f" * len(f1_arms)
+
     def _write(f: TextIO):
         header = "\t".join(["", *(_fmt_allele(f1a) for f1a in f1_arms)])
         f.write(f"{header}\n")
-        for j, f2a in enumerate(f2_arms):
-            f.write("\t".join([_fmt_allele(f2a), *map(str, matrix[j])]) + "\n")
+        for f2a, row in zip(f2_arms, matrix):
+            f.write(_fmt_allele(f2a) + row_fmt % tuple(row.tolist()) + "\n")
 
     if isinstance(out_file, StringIO):
         _write(out_file)
     else:
-        with open(out_file, "w") as fh:
+        with open(out_file, "w", buffering=1 << 20) as fh:
             _write(fh)
 
 
 def compare_samples(scoring: BaseScoringSystem, file1: Path, file2: Path, out_file: Path | StringIO):
     # Step 1: load telomere arms from Telogator2/similar TSV files
     f1_arms, f2_arms = _read_sample_files(scoring, file1, file2)
-    # Step 2: calculate all-all scoring matrix using TVR sequences
-    matrix: list[list[float]] = _compute_matrix(scoring, f1_arms, f2_arms)
-    # Step 3: write scoring matrix to out_file
-    _write_outfile(f1_arms, f2_arms, out_file, matrix)
+    # Step 2: calculate all-all scoring matrix using TVR sequences, and
+    # Step 3: write scoring matrix rows to out_file as they are computed
+    _write_outfile(f1_arms, f2_arms, out_file, _iter_matrix_rows(scoring, f1_arms, f2_arms))
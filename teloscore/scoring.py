@@ -1,7 +1,8 @@
-import math
+import numpy as np
 import parasail
 
 from abc import ABC, abstractmethod
+from typing import ClassVar
 
 from .types import TeloType
 from .utils import decode_cigar
@@ -17,11 +18,44 @@ class BaseScoringSystem(ABC):
     COMPRESSION_LOG_BASE = 4
     DEFAULT_SCORE_LOG_THRESHOLD = 0.8
 
+    GAP_OPEN_PENALTY: int
+    GAP_EXTEND_PENALTY: int
+
+    # Scoring matrices are built from class-level constants, so they can be shared between instances of a class.
+    # SCORING_MATRIX must therefore be treated as read-only: modifying it (e.g. m[i, j] = v) would silently affect every
+    # instance of the class, and would not update query profiles or score bounds already derived from it. To customize
+    # the matrix, override build_scoring_matrix() in a subclass instead.
+    _MATRIX_CACHE: ClassVar[dict[type["BaseScoringSystem"], parasail.Matrix]] = {}
+
     def __init__(self, score_log_threshold: float | None = None):
-        self.SCORING_MATRIX = self.build_scoring_matrix()
+        # parasail's vectorized (SSE4.1/AVX2) kernels, which are picked by its CPU dispatcher at runtime, assume that
+        # opening a gap costs at least as much as extending one.
+        if self.GAP_OPEN_PENALTY < self.GAP_EXTEND_PENALTY:
+            raise ValueError(
+                f"Gap open penalty ({self.GAP_OPEN_PENALTY}) must be >= gap extend penalty ({self.GAP_EXTEND_PENALTY})"
+            )
+
+        if (matrix := self._MATRIX_CACHE.get(type(self))) is None:
+            matrix = self._MATRIX_CACHE[type(self)] = self.build_scoring_matrix()
+        self.SCORING_MATRIX = matrix
+
         self.score_log_threshold = (
             score_log_threshold if score_log_threshold is not None else self.DEFAULT_SCORE_LOG_THRESHOLD
         )
+        # Query profiles and total possible scores, keyed by (encoded) query sequence. The same query is aligned against
+        # many targets when computing a scoring matrix, so we only want to pay these costs once per sequence.
+        self._profiles: dict[str, parasail.Profile] = {}
+        self._total_possible_scores: dict[str, int] = {}
+
+        # Letter compositions (counts of each scoring matrix letter) by sequence, for score_upper_bound().
+        self._compositions: dict[str, np.ndarray] = {}
+        # The composition bound only holds if the only positive scores in the matrix are self-matches.
+        m = self.SCORING_MATRIX.matrix
+        self._self_match_scores = np.maximum(np.diag(m), 0)
+        self._can_bound_scores: bool = bool((m[~np.eye(m.shape[0], dtype=bool)] <= 0).all())
+        # Alignment scores are only symmetric in their two sequences if the scoring matrix is; comparisons can use this
+        # to only score one half of a self-comparison.
+        self.symmetric_scores: bool = bool(np.array_equal(m, m.T))
 
     @abstractmethod
     def build_scoring_matrix(self) -> parasail.Matrix:
@@ -30,37 +64,94 @@ class BaseScoringSystem(ABC):
     def encode_seq(self, seq: str) -> str:
         assert len(seq) > 0
 
-        revised_seq: list[str] = []
-
-        current_char: str = seq[0]
-        current_count: int = 1
+        a = np.frombuffer(seq.encode("ascii"), dtype=np.uint8)
 
-        for c in (*seq[1:], ""):
-            if c == current_char:
-                current_count += 1
-            else:
-                revised_seq.append(
-                    "".join(current_char * int(1.0 + round(math.log(current_count, self.COMPRESSION_LOG_BASE))))
-                )
+        # Find the start of each run of identical characters (plus an end sentinel), then log-compress the run lengths.
+        boundaries = np.flatnonzero(np.concatenate(([True], a[1:] != a[:-1], [True])))
+        run_lengths = np.diff(boundaries)
+        new_counts = (1.0 + np.round(np.log(run_lengths) / np.log(self.COMPRESSION_LOG_BASE))).astype(np.intp)
 
-                current_char = c
-                current_count = 1
+        return np.repeat(a[boundaries[:-1]], new_counts).tobytes().decode("ascii")
 
-        return "".join(revised_seq)
+    def make_profile(self, qs: str) -> parasail.Profile:
+        # Saturation-checking profile: parasail tries 8-bit, then 16-bit, then 32-bit lanes if the score overflows.
+        return parasail.profile_create_sat(qs, self.SCORING_MATRIX)
 
     @abstractmethod
-    def score_seqs(self, seq1: str, seq2: str) -> tuple[float, tuple[tuple[int, int], ...]]:
+    def total_possible_score(self, qs: str) -> int:
         pass
 
-    def build_telo_from_row(self, row: dict) -> TeloType:
-        # required columns in row: #chr/chr    allele_id    tvr_consensus
-        tvr = row["tvr_consensus"]
-        arm = row.get("#chr", row.get("chr", ""))
-        if not arm:
+    def _cached_total_possible_score(self, qs: str) -> int:
+        # total_possible_score(...) also validates the query's letters, so this must be called for every query.
+        if (total := self._total_possible_scores.get(qs)) is None:
+            total = self._total_possible_scores[qs] = self.total_possible_score(qs)
+        return total
+
+    def prepare_query(self, qs: str) -> tuple[parasail.Profile, int]:
+        total_possible_score = self._cached_total_possible_score(qs)
+        if (profile := self._profiles.get(qs)) is None:
+            profile = self._profiles[qs] = self.make_profile(qs)
+        return profile, total_possible_score
+
+    def composition(self, seq: str) -> np.ndarray:
+        if (c := self._compositions.get(seq)) is None:
+            letter_indices = self.SCORING_MATRIX.mapper[np.frombuffer(seq.encode("ascii"), dtype=np.uint8)]
+            c = self._compositions[seq] = np.bincount(letter_indices, minlength=self._self_match_scores.shape[0])
+        return c
+
+    def score_upper_bound(self, seq1: str, seq2: str) -> int:
+        """
+        Cheap upper bound on the raw global alignment score of two sequences. At best, every letter shared between the
+        two sequences' compositions is aligned to itself, and only the gaps required by the length difference are paid.
+        """
+        bound = int(np.minimum(self.composition(seq1), self.composition(seq2)) @ self._self_match_scores)
+        if length_diff := abs(len(seq1) - len(seq2)):
+            bound -= self.GAP_OPEN_PENALTY + (length_diff - 1) * self.GAP_EXTEND_PENALTY
+        return bound
+
+    @staticmethod
+    def _query_and_target(seq1: str, seq2: str) -> tuple[str, str]:
+        # The shorter sequence is used as the query; scores are normalized by the query's total possible score.
+        return (seq1, seq2) if len(seq1) <= len(seq2) else (seq2, seq1)
+
+    def score_only(self, seq1: str, seq2: str) -> float:
+        """
+        Computes the normalized alignment score of two sequences without a traceback, which is considerably faster than
+        score_seqs(...). Use score_seqs(...) if the alignment itself is needed.
+        """
+        qs, dbs = self._query_and_target(seq1, seq2)
+
+        # Validate the query's letters even if alignment ends up being skipped below.
+        self._cached_total_possible_score(qs)
+
+        if self._can_bound_scores and self.score_upper_bound(qs, dbs) <= 0:
+            # The alignment score cannot be positive, so the final (floored) score must be 0 - skip aligning.
+            return 0.0
+
+        profile, total_possible_score = self.prepare_query(qs)
+        # Note: parasail's banded global alignment (nw_banded) is not used here: it is a scalar, non-vectorized
+        # implementation, and restricting the alignment to a band changes scores for TVRs with large indels.
+        r = parasail.nw_striped_profile_sat(profile, dbs, self.GAP_OPEN_PENALTY, self.GAP_EXTEND_PENALTY)
+
+        return max(r.score / total_possible_score, 0.0)
+
+    def score_seqs(self, seq1: str, seq2: str) -> tuple[float, np.ndarray]:
+        qs, dbs = self._query_and_target(seq1, seq2)
+
+        profile, total_possible_score = self.prepare_query(qs)
+        r = parasail.nw_trace_striped_profile_sat(profile, dbs, self.GAP_OPEN_PENALTY, self.GAP_EXTEND_PENALTY)
+
+        final_score: float = max(r.score / total_possible_score, 0.0)
+        return final_score, decode_cigar(r.cigar.seq)
+
+    def build_telo_from_row(self, row: list[str], chr_i: int, allele_id_i: int, tvr_i: int) -> TeloType:
+        # column indices are for the required columns: #chr/chr    allele_id    tvr_consensus
+        if not (arm := row[chr_i]):
             raise ValueError(f"Could not get chromosome arm from row: {row}")
+        tvr = row[tvr_i]
         return {
             "arm": arm,
-            "allele_id": row["allele_id"],
+            "allele_id": row[allele_id_i],
             "tvr_consensus": tvr,
             "tvr_consensus_encoded": self.encode_seq(tvr),
         }
@@ -89,17 +180,8 @@ class Scoring1(BaseScoringSystem):
         m[canonical_index, canonical_index] = self.CANONICAL_MATCH_SCORE
         return m
 
-    def score_seqs(self, seq1: str, seq2: str) -> tuple[float, tuple[tuple[int, int], ...]]:
-        qs, dbs = (seq1, seq2) if len(seq1) <= len(seq2) else (seq2, seq1)
-
-        r = parasail.nw_trace_striped_32(qs, dbs, self.GAP_OPEN_PENALTY, self.GAP_EXTEND_PENALTY, self.SCORING_MATRIX)
-        cigar = r.cigar
-
-        total_possible_score: int = sum(
-            (self.CANONICAL_MATCH_SCORE if qc == self.CANONICAL_LETTER else self.MATCH_SCORE) for qc in qs
-        )
-        final_score: float = max(r.score / total_possible_score, 0.0)
-        return final_score, tuple(decode_cigar(cigar.seq))
+    def total_possible_score(self, qs: str) -> int:
+        return sum((self.CANONICAL_MATCH_SCORE if qc == self.CANONICAL_LETTER else self.MATCH_SCORE) for qc in qs)
 
 
 class Scoring2(BaseScoringSystem):
@@ -128,6 +210,14 @@ class Scoring2(BaseScoringSystem):
 
     DEFAULT_SCORE_LOG_THRESHOLD = 0.6
 
+    def __init__(self, score_log_threshold: float | None = None):
+        super().__init__(score_log_threshold)
+        # Lookup table of match scores, indexed by byte value; -1 marks letters outside the scoring alphabet.
+        self._match_score_table = np.full(256, -1, dtype=np.int32)
+        for letters, v in self.MATCH_SCORES.items():
+            for letter in letters:
+                self._match_score_table[ord(letter)] = v
+
     def build_scoring_matrix(self) -> parasail.Matrix:
         canonical_index = self.SCORING_ALPHABET.index(self.CANONICAL_LETTER)
         canonical_indel_index = self.SCORING_ALPHABET.index("T")
@@ -150,18 +240,13 @@ class Scoring2(BaseScoringSystem):
 
         return m
 
-    def match_score_for_letter(self, x: str):
-        for k, v in self.MATCH_SCORES.items():
-            if x in k:
-                return v
-        raise ValueError(f"Invalid letter encountered: {x}")
-
-    def score_seqs(self, seq1: str, seq2: str) -> tuple[float, tuple[tuple[int, int], ...]]:
-        qs, dbs = (seq1, seq2) if len(seq1) <= len(seq2) else (seq2, seq1)
+    def match_score_for_letter(self, x: str) -> int:
+        if (o := ord(x)) > 255 or (v := int(self._match_score_table[o])) < 0:
+            raise ValueError(f"Invalid letter encountered: {x}")
+        return v
 
-        r = parasail.nw_trace_striped_32(qs, dbs, self.GAP_OPEN_PENALTY, self.GAP_EXTEND_PENALTY, self.SCORING_MATRIX)
-        cigar = r.cigar
-
-        total_possible_score: int = sum(map(self.match_score_for_letter, qs))
-        final_score: float = max(r.score / total_possible_score, 0.0)
-        return final_score, tuple(decode_cigar(cigar.seq))
+    def total_possible_score(self, qs: str) -> int:
+        scores = self._match_score_table[np.frombuffer(qs.encode("ascii"), dtype=np.uint8)]
+        if (invalid := scores < 0).any():
+            raise ValueError(f"Invalid letter encountered: {qs[int(np.argmax(invalid))]}")
+        return int(scores.sum())
@@ -1,16 +1,16 @@
-from typing import Iterable
+import numpy as np
 
 __all__ = ["decode_cigar"]
 
-# Taken from STRkit: https://github.com/davidlougheed/strkit/blob/master/strkit/call/cigar.py
+# Adapted from STRkit: https://github.com/davidlougheed/strkit/blob/master/strkit/call/cigar.py
 
 
-def _decode_cigar_item(item: int) -> tuple[int, int]:
-    return item & 15, item >> 4
+def decode_cigar(encoded_cigar: np.ndarray | list[int]) -> np.ndarray:
+    """
+    Decodes a BAM/parasail-encoded CIGAR into an (n, 2) array of (operation, count) rows.
+    """
+    a = np.asarray(encoded_cigar, dtype=np.uint32)
+    return np.stack((a & 15, a >> 4), axis=1)
 
 
-def decode_cigar(encoded_cigar: list[int]) -> Iterable[tuple[int, int]]:
-    return map(_decode_cigar_item, encoded_cigar)
-
-
-# End taken from STRkit
+# End adapted from STRkit
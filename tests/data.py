@@ -0,0 +1,19 @@
+from pathlib import Path
+
+__all__ = [
+    "TEST_DATA_DIR",
+    "HG002",
+    "HG003",
+    "HG004",
+    "OUT_0_1_0_HG002_HG003",
+    "OUT_0_1_0_HG002_HG004",
+]
+
+TEST_DATA_DIR = Path(__file__).parent.parent / "test_data"
+
+HG002 = TEST_DATA_DIR / "tlens_by_allele_HG002.tsv"
+HG003 = TEST_DATA_DIR / "tlens_by_allele_HG003.tsv"
+HG004 = TEST_DATA_DIR / "tlens_by_allele_HG004.tsv"
+
+OUT_0_1_0_HG002_HG003 = TEST_DATA_DIR / "out_0_1_0_HG002_HG003.tsv"
+OUT_0_1_0_HG002_HG004 = TEST_DATA_DIR / "out_0_1_0_HG002_HG004.tsv"
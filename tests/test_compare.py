@@ -1,21 +1,26 @@
 import io
-from pathlib import Path
+import numpy as np
+import pytest
 from teloscore import compare, scoring
 
-TEST_DATA_DIR = Path(__file__).parent.parent / "test_data"
+from .data import HG002, HG003, HG004, OUT_0_1_0_HG002_HG003, OUT_0_1_0_HG002_HG004
 
-HG002 = TEST_DATA_DIR / "tlens_by_allele_HG002.tsv"
-HG003 = TEST_DATA_DIR / "tlens_by_allele_HG003.tsv"
-HG004 = TEST_DATA_DIR / "tlens_by_allele_HG004.tsv"
 
-OUT_0_1_0_HG002_HG003 = TEST_DATA_DIR / "out_0_1_0_HG002_HG003.tsv"
-OUT_0_1_0_HG002_HG004 = TEST_DATA_DIR / "out_0_1_0_HG002_HG004.tsv"
+def _round_matrix_output(data: str) -> str:
+    # Reference outputs were written with full float precision; scores are now written to a fixed number of places.
+    header, *rows = data.splitlines()
+    rounded_rows = []
+    for row in rows:
+        allele, *scores = row.split("\t")
+        rounded_rows.append("\t".join([allele, *(f"{float(v):.{compare.SCORE_DECIMAL_PLACES}f}" for v in scores)]))
+    return "\n".join([header, *rounded_rows]) + "\n"
+
 
 with open(OUT_0_1_0_HG002_HG003, "r") as ofh:
-    OUT_0_1_0_HG002_HG003_DATA = ofh.read()
+    OUT_0_1_0_HG002_HG003_DATA = _round_matrix_output(ofh.read())
 
 with open(OUT_0_1_0_HG002_HG004, "r") as ofh:
-    OUT_0_1_0_HG002_HG004_DATA = ofh.read()
+    OUT_0_1_0_HG002_HG004_DATA = _round_matrix_output(ofh.read())
 
 
 def test_loading():
@@ -25,6 +30,28 @@ def test_loading():
     assert len(hg003_alleles) == 43
 
 
+def test_loading_trailing_blank_line(tmp_path):
+    s = scoring.Scoring1()
+    blank_line_file = tmp_path / "blank_line.tsv"
+    blank_line_file.write_text(HG002.read_text() + "\n")
+
+    assert compare._read_sample_file(s, blank_line_file) == compare._read_sample_file(s, HG002)
+
+
+def test_loading_chr_col_without_tvr_len(tmp_path):
+    s = scoring.Scoring1()
+    chr_file = tmp_path / "chr.tsv"
+    chr_file.write_text("chr\tallele_id\ttvr_consensus\nchr1p\t1\tCCCCCCAAAA\nchr2q\t2i\tCMMC\n")
+
+    alleles = compare._read_sample_file(s, chr_file)
+
+    assert [(a["arm"], a["allele_id"], a["tvr_consensus"]) for a in alleles] == [
+        ("chr1p", "1", "CCCCCCAAAA"),
+        ("chr2q", "2i", "CMMC"),
+    ]
+    assert alleles[0]["tvr_consensus_encoded"] == s.encode_seq("CCCCCCAAAA")
+
+
 def test_compare_s1_hg002_hg003():
     with io.StringIO() as fh:
         compare.compare_samples(scoring.Scoring1(), HG002, HG003, fh)
@@ -46,3 +73,65 @@ def test_compare_s2():
         compare.compare_samples(scoring.Scoring2(), HG002, HG004, fh)
         fh.seek(0)
         # TODO
+
+
+class _AsymmetricScoring2(scoring.Scoring2):
+    def build_scoring_matrix(self):
+        m = super().build_scoring_matrix()
+        m[self.SCORING_ALPHABET.index("T"), self.SCORING_ALPHABET.index("C")] = self.MISMATCH_SCORE
+        return m
+
+
+@pytest.mark.parametrize("scoring_cls", [scoring.Scoring2, _AsymmetricScoring2])
+def test_compare_self_symmetric(scoring_cls):
+    s = scoring_cls()
+    assert s.symmetric_scores == (scoring_cls is scoring.Scoring2)
+    hg002_alleles, _ = compare._read_sample_files(s, HG002, HG003)
+    matrix = np.array(list(compare._iter_matrix_rows(s, hg002_alleles, hg002_alleles)))
+
+    seqs = [a["tvr_consensus_encoded"] for a in hg002_alleles]
+    expected = np.array([[s.score_only(seq1, seq2) for seq1 in seqs] for seq2 in seqs])
+    assert np.array_equal(matrix, expected)
+
+
+def test_write_outfile_full_precision():
+    arms = [{"arm": "chr1p", "allele_id": "1", "tvr_consensus": "C", "tvr_consensus_encoded": "C"}]
+    with io.StringIO() as fh:
+        # 3/160 is a rounding tie at 4 decimal places in float32 (0.0188), but not in float64 (0.0187)
+        compare._write_outfile(arms, arms, fh, iter([np.array([3 / 160])]))
+        assert fh.getvalue() == "\t(1) chr1p\n(1) chr1p\t0.0187\n"
+
+
+def test_compare_streamed_matches_collected_matrix():
+    s = scoring.Scoring2()
+    hg002_alleles, hg004_alleles = compare._read_sample_files(s, HG002, HG004)
+
+    with io.StringIO() as fh:
+        compare.compare_samples(s, HG002, HG004, fh)
+        streamed_out = fh.getvalue()
+
+    with io.StringIO() as fh:
+        matrix = np.array(list(compare._iter_matrix_rows(s, hg002_alleles, hg004_alleles)))
+        compare._write_outfile(hg002_alleles, hg004_alleles, fh, matrix)
+        matrix_out = fh.getvalue()
+
+    assert streamed_out == matrix_out
+
+
+def test_iter_matrix_rows_stop_early():
+    s = scoring.Scoring2()
+    hg002_alleles, hg004_alleles = compare._read_sample_files(s, HG002, HG004)
+
+    rows = compare._iter_matrix_rows(s, hg002_alleles, hg004_alleles)
+    assert len(next(rows)) == len(hg002_alleles)
+    rows.close()  # cancels remaining rows rather than waiting for them
+
+
+def test_fmt_alignment():
+    s = scoring.Scoring2()
+    seq1, seq2 = "ACDEFGHIKLM", "ACDQEFGWIKM"
+
+    _, cigar = s.score_seqs(seq1, seq2)
+    # Matches, a deletion (Q), a mismatch (H/W) and an insertion (L)
+    assert cigar.tolist() == [[7, 3], [2, 1], [7, 3], [8, 1], [7, 2], [1, 1], [7, 1]]
+    assert compare._fmt_alignment(seq1, seq2, cigar) == "ACD-EFGHIKLM\n||| |||X|| |\nACDQEFGWIK-M"
@@ -0,0 +1,32 @@
+import parasail
+import pytest
+from teloscore import compare, scoring
+
+from .data import HG002, HG004
+
+
+@pytest.mark.parametrize("scoring_cls", [scoring.Scoring1, scoring.Scoring2])
+def test_score_upper_bound(scoring_cls):
+    s = scoring_cls()
+    hg002_alleles, hg004_alleles = compare._read_sample_files(s, HG002, HG004)
+
+    for a1 in hg002_alleles:
+        for a2 in hg004_alleles:
+            seq1, seq2 = a1["tvr_consensus_encoded"], a2["tvr_consensus_encoded"]
+            r = parasail.nw_striped_sat(seq1, seq2, s.GAP_OPEN_PENALTY, s.GAP_EXTEND_PENALTY, s.SCORING_MATRIX)
+            assert r.score <= s.score_upper_bound(seq1, seq2)
+
+
+def test_scoring_matrix_shared_per_class():
+    assert scoring.Scoring1().SCORING_MATRIX is scoring.Scoring1().SCORING_MATRIX
+    assert scoring.Scoring2().SCORING_MATRIX is scoring.Scoring2().SCORING_MATRIX
+    assert scoring.Scoring1().SCORING_MATRIX is not scoring.Scoring2().SCORING_MATRIX
+
+
+def test_invalid_letter_s2():
+    s = scoring.Scoring2()
+    # This pair's alignment is skipped by the score upper bound, but the query's letters must still be validated.
+    with pytest.raises(ValueError, match="Invalid letter encountered: B"):
+        s.score_only("CBZBZBZBZ", "MKMKMKMKMKMKMKLL")
+    with pytest.raises(ValueError, match="Invalid letter encountered: B"):
+        s.score_seqs("CBZBZBZBZ", "MKMKMKMKMKMKMKLL")
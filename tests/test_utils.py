@@ -0,0 +1,9 @@
+import numpy as np
+from teloscore.utils import decode_cigar
+
+
+def test_decode_cigar():
+    # 3=, 1D, 3=, 1X, 2=, 1I, 1= (count << 4 | op)
+    encoded = [3 << 4 | 7, 1 << 4 | 2, 3 << 4 | 7, 1 << 4 | 8, 2 << 4 | 7, 1 << 4 | 1, 1 << 4 | 7]
+    assert decode_cigar(encoded).tolist() == [[7, 3], [2, 1], [7, 3], [8, 1], [7, 2], [1, 1], [7, 1]]
+    assert decode_cigar(np.array([], dtype=np.uint32)).shape == (0, 2)